@@ -4,18 +4,209 @@ Handles end-to-end encryption for video data and other sensitive content.
 """
 
 import os
+import sys
+import ctypes
+import ctypes.util
 import hashlib
+import ipaddress
+import re
 import secrets
 from cryptography.fernet import Fernet
 from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.asymmetric import rsa, padding
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
 import base64
 import json
-from typing import Tuple, Optional, Dict, Any
+import time
+from typing import Tuple, Optional, Dict, Any, BinaryIO, List
 import tempfile
 
+try:
+    # Rust implementation of the same Fernet token format
+    from rfernet import Fernet as RFernet
+except ImportError:
+    RFernet = None
+
+try:
+    # SIMD regex engine: scans text for all patterns at once
+    import hyperscan
+except ImportError:
+    hyperscan = None
+
+# secure_delete_file overwrites in blocks of this size, so a large file never
+# needs a matching amount of random data in memory
+OVERWRITE_CHUNK_SIZE = 1024 * 1024  # 1MB
+
+# Encrypted video files start with this header followed by one algorithm byte;
+# files without it are in the legacy per-chunk Fernet format. SMV1 files
+# authenticate each chunk's index only, so they cannot detect dropped
+# trailing chunks; they are still read but no longer written.
+FILE_FORMAT_MAGIC = b"SMV2"
+FILE_FORMAT_MAGIC_V1 = b"SMV1"
+FILE_NONCE_SIZE = 12
+
+# Output buffer for encrypted/decrypted files, so the many small frame writes
+# reach the OS as 1MB writes
+FILE_WRITE_BUFFER_SIZE = 1024 * 1024
+
+# Anonymized IPs keep their network part: the /24 of an IPv4 address and the
+# /64 of an IPv6 address
+IPV4_ANONYMIZATION_MASK = 0xFFFFFF00
+IPV6_ANONYMIZATION_MASK = ((1 << 64) - 1) << 64
+
+# fallocate(2) mode used by secure_delete_file to deallocate a file's blocks
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+# Salt for hash_identifier when the caller does not provide one
+DEFAULT_IDENTIFIER_SALT = "default_skillmirror_salt"
+
+# Sensitive patterns replaced by anonymize_text_data by default, in priority
+# order for matches starting at the same position
+DEFAULT_TEXT_PATTERNS = (
+    (r'\b\d{3}-\d{2}-\d{4}\b', '***-**-****'),  # SSN
+    (r'\b\d{4}[-\s]?\d{4}[-\s]?\d{4}[-\s]?\d{4}\b', '****-****-****-****'),  # Credit card
+    (r'\b\d{10,11}\b', '**********'),  # Phone number
+)
+
+# One alternation of all default patterns, so the text is scanned once
+DEFAULT_TEXT_REGEX = re.compile("|".join(f"({pattern})" for pattern, _ in DEFAULT_TEXT_PATTERNS))
+
+AEAD_ALGORITHMS = {
+    1: ("AES-256-GCM", AESGCM),
+    2: ("ChaCha20-Poly1305", ChaCha20Poly1305),
+}
+
+
+def _select_file_aead() -> int:
+    """Pick the faster AEAD on this CPU (AES-GCM with AES-NI, otherwise ChaCha20-Poly1305)."""
+    sample = bytes(1024 * 1024)
+    nonce = bytes(FILE_NONCE_SIZE)
+    timings = {}
+    for algorithm_id, (_, aead_class) in AEAD_ALGORITHMS.items():
+        aead = aead_class(bytes(32))
+        best = float("inf")
+        for _ in range(3):
+            start = time.perf_counter()
+            aead.encrypt(nonce, sample, None)
+            best = min(best, time.perf_counter() - start)
+        timings[algorithm_id] = best
+    return min(timings, key=timings.get)
+
+
+FILE_AEAD_ID = _select_file_aead()
+
+
+def _chunk_aad(index: int, is_last: bool) -> bytes:
+    """Associated data of an encrypted file chunk: its index, so chunks cannot be
+    reordered, and whether it is the last one, so the file cannot be truncated."""
+    return index.to_bytes(8, 'big') + (b"\x01" if is_last else b"\x00")
+
+
+def _compile_text_database():
+    """Compile the default text patterns for hyperscan, or None to use DEFAULT_TEXT_REGEX."""
+    if hyperscan is None:
+        return None
+    try:
+        database = hyperscan.Database()
+        database.compile(
+            expressions=[pattern.encode() for pattern, _ in DEFAULT_TEXT_PATTERNS],
+            ids=list(range(len(DEFAULT_TEXT_PATTERNS))),
+            elements=len(DEFAULT_TEXT_PATTERNS),
+            flags=[hyperscan.HS_FLAG_SOM_LEFTMOST] * len(DEFAULT_TEXT_PATTERNS),
+        )
+    except Exception as e:
+        print(f"Hyperscan compile failed, using re: {e}")
+        return None
+    return database
+
+
+DEFAULT_TEXT_DATABASE = _compile_text_database()
+
+
+def _anonymize_text_with_hyperscan(text: str) -> str:
+    """Replace default-pattern matches found by one hyperscan pass, leftmost-longest first."""
+    data = text.encode()
+    matches = []
+    DEFAULT_TEXT_DATABASE.scan(
+        data,
+        match_event_handler=lambda pattern_id, start, end, flags, context: matches.append((start, -end, pattern_id))
+    )
+    matches.sort()
+    
+    output = bytearray()
+    position = 0
+    for start, negative_end, pattern_id in matches:
+        if start < position:
+            continue  # Overlaps a span that was already replaced
+        output += data[position:start]
+        output += DEFAULT_TEXT_PATTERNS[pattern_id][1].encode()
+        position = -negative_end
+    output += data[position:]
+    
+    return output.decode()
+
+
+def _load_fallocate():
+    """libc's fallocate(2) where available (Linux), otherwise None."""
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        fallocate = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True).fallocate
+    except (OSError, AttributeError):
+        return None
+    fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    fallocate.restype = ctypes.c_int
+    return fallocate
+
+
+FALLOCATE = _load_fallocate()
+
+
+def _punch_hole(fd: int, size: int) -> bool:
+    """Deallocate the first size bytes of fd; False if the filesystem cannot."""
+    if FALLOCATE is None:
+        return False
+    return FALLOCATE(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, 0, size) == 0
+
+
+def _is_rotational(path: str) -> bool:
+    """Whether path lives on a spinning disk, per sysfs (False when unknown)."""
+    device = os.stat(path).st_dev
+    device_dir = f"/sys/dev/block/{os.major(device)}:{os.minor(device)}"
+    # Partitions keep the queue attributes on their parent disk
+    for queue_dir in (f"{device_dir}/queue", f"{device_dir}/../queue"):
+        try:
+            with open(f"{queue_dir}/rotational") as rotational:
+                return rotational.read().strip() == "1"
+        except OSError:
+            continue
+    return False
+
+
+class _RFernetAdapter:
+    """rfernet behind cryptography.Fernet's bytes-in, bytes-out interface (rfernet
+    tokens are str)."""
+    
+    def __init__(self, key: bytes):
+        self._fernet = RFernet(key.decode())
+    
+    def encrypt(self, data: bytes) -> bytes:
+        return self._fernet.encrypt(data).encode()
+    
+    def decrypt(self, token: bytes) -> bytes:
+        return self._fernet.decrypt(token.decode())
+
+
+def _fernet(key: bytes):
+    """Fernet instance for key, backed by rfernet when it is installed."""
+    if RFernet is not None:
+        return _RFernetAdapter(key)
+    return Fernet(key)
+
+
 class VideoEncryptionService:
     """Service for encrypting/decrypting video files and data."""
     
@@ -64,33 +255,54 @@ class VideoEncryptionService:
     
     def encrypt_file(self, file_path: str, output_path: str, key: bytes = None) -> Dict[str, Any]:
         """Encrypt a file (especially video files) with AES encryption."""
+        with open(file_path, 'rb') as input_file:
+            return self.encrypt_stream(input_file, output_path, key)
+    
+    def encrypt_stream(self, input_file: BinaryIO, output_path: str, key: bytes = None) -> Dict[str, Any]:
+        """Encrypt a readable binary stream (file or in-memory buffer) to output_path."""
         if key is None:
             key = self.generate_key()
         
-        fernet = Fernet(key)
+        # Fernet keys are urlsafe base64 of 32 random bytes, usable directly as an AEAD key
+        algorithm_name, aead_class = AEAD_ALGORITHMS[FILE_AEAD_ID]
+        aead = aead_class(base64.urlsafe_b64decode(key))
         
-        # Read file in chunks to handle large video files
+        # Read stream in chunks to handle large video files
         chunk_size = 64 * 1024  # 64KB chunks
         
-        with open(file_path, 'rb') as input_file, open(output_path, 'wb') as output_file:
+        # Hash the plaintext while it is being encrypted so the input is only read once
+        sha256_hash = hashlib.sha256()
+        
+        with open(output_path, 'wb', buffering=FILE_WRITE_BUFFER_SIZE) as output_file:
+            output_file.write(FILE_FORMAT_MAGIC + bytes([FILE_AEAD_ID]))
+            # Read one chunk ahead to know which chunk is the last; an empty
+            # input still gets one (empty) last chunk
+            chunk = input_file.read(chunk_size)
+            chunk_index = 0
             while True:
-                chunk = input_file.read(chunk_size)
-                if not chunk:
-                    break
+                next_chunk = input_file.read(chunk_size) if chunk else b""
+                is_last = not next_chunk
                 
-                encrypted_chunk = fernet.encrypt(chunk)
+                sha256_hash.update(chunk)
+                nonce = os.urandom(FILE_NONCE_SIZE)
+                encrypted_chunk = nonce + aead.encrypt(nonce, chunk, _chunk_aad(chunk_index, is_last))
                 # Write chunk size followed by encrypted chunk
                 output_file.write(len(encrypted_chunk).to_bytes(4, 'big'))
                 output_file.write(encrypted_chunk)
+                
+                if is_last:
+                    break
+                chunk = next_chunk
+                chunk_index += 1
         
-        # Generate file hash for integrity verification
-        file_hash = self._calculate_file_hash(file_path)
+        # File hash for integrity verification
+        file_hash = sha256_hash.hexdigest()
         
         return {
             "key": base64.b64encode(key).decode(),
             "file_hash": file_hash,
             "encrypted_file": output_path,
-            "algorithm": "AES-256-CBC"
+            "algorithm": algorithm_name
         }
     
     def decrypt_file(self, encrypted_path: str, output_path: str, key: str, 
@@ -98,23 +310,43 @@ class VideoEncryptionService:
         """Decrypt a file and verify integrity."""
         try:
             key_bytes = base64.b64decode(key.encode())
-            fernet = Fernet(key_bytes)
             
-            with open(encrypted_path, 'rb') as input_file, open(output_path, 'wb') as output_file:
-                while True:
-                    # Read chunk size
-                    size_bytes = input_file.read(4)
-                    if not size_bytes:
-                        break
-                    
+            with open(encrypted_path, 'rb') as input_file, \
+                    open(output_path, 'wb', buffering=FILE_WRITE_BUFFER_SIZE) as output_file:
+                header = input_file.read(len(FILE_FORMAT_MAGIC))
+                if header in (FILE_FORMAT_MAGIC, FILE_FORMAT_MAGIC_V1):
+                    _, aead_class = AEAD_ALGORITHMS[input_file.read(1)[0]]
+                    aead = aead_class(base64.urlsafe_b64decode(key_bytes))
+                    if header == FILE_FORMAT_MAGIC:
+                        chunk_aad = _chunk_aad
+                    else:
+                        chunk_aad = lambda index, is_last: index.to_bytes(8, 'big')
+                    decrypt_chunk = lambda index, is_last, chunk: aead.decrypt(
+                        chunk[:FILE_NONCE_SIZE], chunk[FILE_NONCE_SIZE:], chunk_aad(index, is_last)
+                    )
+                else:
+                    # Legacy Fernet file: the bytes read were the first chunk size
+                    input_file.seek(0)
+                    fernet = Fernet(key_bytes)
+                    decrypt_chunk = lambda index, is_last, chunk: fernet.decrypt(chunk)
+                
+                # Read each chunk's size up front, so a chunk is known to be the
+                # last one before it is decrypted
+                size_bytes = input_file.read(4)
+                if header == FILE_FORMAT_MAGIC and not size_bytes:
+                    raise ValueError("Encrypted file is truncated")
+                
+                chunk_index = 0
+                while size_bytes:
                     chunk_size = int.from_bytes(size_bytes, 'big')
                     encrypted_chunk = input_file.read(chunk_size)
+                    if len(encrypted_chunk) != chunk_size:
+                        raise ValueError("Encrypted file is truncated")
                     
-                    if not encrypted_chunk:
-                        break
-                    
-                    decrypted_chunk = fernet.decrypt(encrypted_chunk)
+                    size_bytes = input_file.read(4)
+                    decrypted_chunk = decrypt_chunk(chunk_index, not size_bytes, encrypted_chunk)
                     output_file.write(decrypted_chunk)
+                    chunk_index += 1
             
             # Verify file integrity if hash provided
             if expected_hash:
@@ -132,7 +364,7 @@ class VideoEncryptionService:
         if key is None:
             key = self.generate_key()
         
-        fernet = Fernet(key)
+        fernet = _fernet(key)
         encrypted_data = fernet.encrypt(data)
         
         return {
@@ -146,7 +378,7 @@ class VideoEncryptionService:
             key_bytes = base64.b64decode(key.encode())
             encrypted_bytes = base64.b64decode(encrypted_data.encode())
             
-            fernet = Fernet(key_bytes)
+            fernet = _fernet(key_bytes)
             decrypted_data = fernet.decrypt(encrypted_bytes)
             
             return decrypted_data
@@ -154,6 +386,20 @@ class VideoEncryptionService:
             print(f"Data decryption failed: {e}")
             return None
     
+    def encrypt_data_aead(self, data: bytes, key: bytes, aad: bytes = None) -> Tuple[bytes, bytes]:
+        """Encrypt a binary payload (e.g. a video chunk) with AES-256-GCM and return raw (nonce, ciphertext)."""
+        # Same key format as encrypt_data; the payload is not base64-encoded
+        nonce = os.urandom(FILE_NONCE_SIZE)
+        return nonce, AESGCM(base64.urlsafe_b64decode(key)).encrypt(nonce, data, aad)
+    
+    def decrypt_data_aead(self, nonce: bytes, ciphertext: bytes, key: bytes, aad: bytes = None) -> Optional[bytes]:
+        """Decrypt a payload produced by encrypt_data_aead with the same associated data."""
+        try:
+            return AESGCM(base64.urlsafe_b64decode(key)).decrypt(nonce, ciphertext, aad)
+        except Exception as e:
+            print(f"Data decryption failed: {e}")
+            return None
+    
     def encrypt_with_public_key(self, data: bytes, public_key_pem: bytes) -> bytes:
         """Encrypt data with RSA public key."""
         public_key = serialization.load_pem_public_key(public_key_pem)
@@ -189,11 +435,10 @@ class VideoEncryptionService:
     
     def _calculate_file_hash(self, file_path: str) -> str:
         """Calculate SHA-256 hash of a file."""
-        sha256_hash = hashlib.sha256()
+        # file_digest reads into a reused buffer and hashes in C, with no
+        # Python-level loop
         with open(file_path, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                sha256_hash.update(chunk)
-        return sha256_hash.hexdigest()
+            return hashlib.file_digest(f, "sha256").hexdigest()
     
     def create_secure_temp_file(self, data: bytes, suffix: str = ".tmp") -> str:
         """Create a secure temporary file with encrypted data."""
@@ -222,20 +467,28 @@ class VideoEncryptionService:
             raise e
     
     def secure_delete_file(self, file_path: str) -> bool:
-        """Securely delete a file by overwriting with random data."""
+        """Delete a file after discarding its contents.
+        
+        Overwrites do not reach the old cells on flash storage, so there the blocks
+        are deallocated instead; spinning disks get one random overwrite. Data that
+        must be unrecoverable should be stored encrypted in the first place.
+        """
         try:
             if not os.path.exists(file_path):
                 return True
             
             file_size = os.path.getsize(file_path)
             
-            # Overwrite with random data multiple times
             with open(file_path, 'r+b') as file:
-                for _ in range(3):  # 3 passes
-                    file.seek(0)
-                    file.write(secrets.token_bytes(file_size))
+                if _is_rotational(file_path) or not _punch_hole(file.fileno(), file_size):
+                    # One pass of random data, written in bounded chunks
+                    remaining = file_size
+                    while remaining > 0:
+                        chunk_size = min(remaining, OVERWRITE_CHUNK_SIZE)
+                        file.write(secrets.token_bytes(chunk_size))
+                        remaining -= chunk_size
                     file.flush()
-                    os.fsync(file.fileno())
+                    os.fdatasync(file.fileno())
             
             # Finally delete the file
             os.unlink(file_path)
@@ -251,15 +504,21 @@ class DataAnonymizer:
     
     @staticmethod
     def anonymize_ip_address(ip: str) -> str:
-        """Anonymize IP address by masking the last octet."""
-        if '.' in ip:  # IPv4
-            parts = ip.split('.')
-            if len(parts) == 4:
-                return f"{parts[0]}.{parts[1]}.{parts[2]}.0"
-        elif ':' in ip:  # IPv6
-            parts = ip.split(':')
-            return ':'.join(parts[:4] + ['0'] * (8 - 4))
-        return "0.0.0.0"
+        """Anonymize IP address by masking the last octet (IPv4) or interface ID (IPv6)."""
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return "0.0.0.0"
+        
+        if address.version == 4:
+            return str(ipaddress.IPv4Address(int(address) & IPV4_ANONYMIZATION_MASK))
+        return ipaddress.IPv6Address(int(address) & IPV6_ANONYMIZATION_MASK).exploded
+    
+    @staticmethod
+    def anonymize_ip_batch(ips: List[str]) -> List[str]:
+        """Anonymize many IP addresses (e.g. every row of a log listing)."""
+        anonymize = DataAnonymizer.anonymize_ip_address
+        return [anonymize(ip) for ip in ips]
     
     @staticmethod
     def anonymize_email(email: str) -> str:
@@ -276,14 +535,13 @@ class DataAnonymizer:
     @staticmethod
     def anonymize_text_data(text: str, patterns: Dict[str, str] = None) -> str:
         """Anonymize text data by replacing sensitive patterns."""
-        import re
-        
         if patterns is None:
-            patterns = {
-                r'\b\d{3}-\d{2}-\d{4}\b': '***-**-****',  # SSN
-                r'\b\d{4}[-\s]?\d{4}[-\s]?\d{4}[-\s]?\d{4}\b': '****-****-****-****',  # Credit card
-                r'\b\d{10,11}\b': '**********',  # Phone number
-            }
+            # Default patterns: a single scan of the text
+            if DEFAULT_TEXT_DATABASE is not None:
+                return _anonymize_text_with_hyperscan(text)
+            return DEFAULT_TEXT_REGEX.sub(
+                lambda match: DEFAULT_TEXT_PATTERNS[match.lastindex - 1][1], text
+            )
         
         anonymized_text = text
         for pattern, replacement in patterns.items():
@@ -291,11 +549,31 @@ class DataAnonymizer:
         
         return anonymized_text
     
+    @staticmethod
+    def anonymize_batch(record: Dict[str, str]) -> Dict[str, str]:
+        """Anonymize a record's "ip", "email" and "text" fields in one call; other
+        fields are returned unchanged."""
+        anonymized = dict(record)
+        if "ip" in record:
+            anonymized["ip"] = DataAnonymizer.anonymize_ip_address(record["ip"])
+        if "email" in record:
+            anonymized["email"] = DataAnonymizer.anonymize_email(record["email"])
+        if "text" in record:
+            anonymized["text"] = DataAnonymizer.anonymize_text_data(record["text"])
+        return anonymized
+    
     @staticmethod
     def hash_identifier(identifier: str, salt: str = None) -> str:
         """Create a consistent hash for identifiers while maintaining anonymity."""
         if salt is None:
-            salt = "default_skillmirror_salt"
+            salt = DEFAULT_IDENTIFIER_SALT
         
         combined = f"{identifier}{salt}"
-        return hashlib.sha256(combined.encode()).hexdigest()[:16]
\ No newline at end of file
+        return hashlib.sha256(combined.encode()).hexdigest()[:16]
+    
+    @staticmethod
+    def hash_identifiers(identifiers: List[str], salt: str = None) -> List[str]:
+        """hash_identifier for many identifiers, encoding the salt only once."""
+        salt_bytes = (DEFAULT_IDENTIFIER_SALT if salt is None else salt).encode()
+        sha256 = hashlib.sha256
+        return [sha256(identifier.encode() + salt_bytes).hexdigest()[:16] for identifier in identifiers]
\ No newline at end of file
@@ -5,30 +5,46 @@ FastAPI endpoints for security, compliance, and privacy management.
 
 from fastapi import FastAPI, HTTPException, Depends, Request, UploadFile, File, BackgroundTasks
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse, FileResponse
 from pydantic import BaseModel, EmailStr
 from typing import Optional, List, Dict, Any
 import json
+import multiprocessing
 import os
 from datetime import datetime, timedelta
+import io
 import tempfile
 import asyncio
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+from functools import lru_cache
 
 # Import our security modules
 from security_database import SecurityDatabase
 from encryption_service import VideoEncryptionService, DataAnonymizer
 from authentication_service import AuthenticationService, TwoFactorAuthService, SessionManager
 
-app = FastAPI(title="SkillMirror Security API", version="1.0.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Write out queued security events and stop encryption workers before the process exits."""
+    yield
+    if _encryption_executor is not None:
+        _encryption_executor.shutdown()
+    security_db.close()
+
+app = FastAPI(title="SkillMirror Security API", version="1.0.0", lifespan=lifespan)
 
 # CORS middleware
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:3000", "https://skillmirror.app"],
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST"],
+    allow_headers=["authorization", "content-type"],
 )
 
 # Security services
@@ -39,6 +55,31 @@ totp_service = TwoFactorAuthService()
 session_manager = SessionManager()
 security = HTTPBearer()
 
+# Video encryption is CPU-bound; run it in worker processes so it neither
+# blocks the event loop nor contends for the GIL. The pool is capped because
+# every server worker process gets its own.
+ENCRYPTION_MAX_WORKERS = min(4, os.cpu_count() or 1)
+_encryption_executor: Optional[ProcessPoolExecutor] = None
+
+def _get_encryption_executor() -> ProcessPoolExecutor:
+    """Encryption process pool, started on first use."""
+    global _encryption_executor
+    if _encryption_executor is None:
+        # Spawn rather than fork: this process already runs threads (the
+        # security log writer, the server's thread pool)
+        _encryption_executor = ProcessPoolExecutor(
+            max_workers=ENCRYPTION_MAX_WORKERS,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+    return _encryption_executor
+
+# Uploads up to this size are encrypted straight from memory
+IN_MEMORY_VIDEO_MAX_SIZE = 32 * 1024 * 1024  # 32MB
+
+# Health probes arrive at high frequency; share one timestamp string per 100ms
+HEALTH_TIMESTAMP_TTL = 0.1
+_health_timestamp_cache = (0.0, "")
+
 # Pydantic models
 class SecurityLogRequest(BaseModel):
     action: str
@@ -78,8 +119,9 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
         raise HTTPException(status_code=401, detail="Invalid token")
     return token_data
 
-async def require_permission(permission: str):
-    """Decorator to require specific permission."""
+@lru_cache(maxsize=32)
+def require_permission(permission: str):
+    """Dependency factory requiring a specific permission (one checker per permission)."""
     def permission_checker(user_data: dict = Depends(get_current_user)):
         user_role = user_data.get("role", "user")
         if not auth_service.check_permission(user_role, permission):
@@ -213,8 +255,9 @@ async def get_security_logs(
     
     # Anonymize sensitive data for non-admin users
     if user_data.get("role") != "admin":
-        for log in logs:
-            log["ip_address"] = DataAnonymizer.anonymize_ip_address(log["ip_address"])
+        anonymized_ips = DataAnonymizer.anonymize_ip_batch([log["ip_address"] for log in logs])
+        for log, anonymized_ip in zip(logs, anonymized_ips):
+            log["ip_address"] = anonymized_ip
     
     return {"logs": logs}
 
@@ -321,18 +364,38 @@ async def encrypt_video(
     if not video_file.content_type.startswith("video/"):
         raise HTTPException(status_code=400, detail="File must be a video")
     
-    # Save uploaded file temporarily
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".tmp") as temp_file:
-        content = await video_file.read()
-        temp_file.write(content)
-        temp_file_path = temp_file.name
-    
-    # Encrypt the video
-    encrypted_file_path = temp_file_path + ".encrypted"
-    encryption_result = encryption_service.encrypt_file(
-        file_path=temp_file_path,
-        output_path=encrypted_file_path
-    )
+    loop = asyncio.get_running_loop()
+    
+    if video_file.size is not None and video_file.size <= IN_MEMORY_VIDEO_MAX_SIZE:
+        # Small uploads never get a plaintext copy on disk, so no secure delete is needed
+        fd, encrypted_file_path = tempfile.mkstemp(suffix=".tmp.encrypted")
+        os.close(fd)
+        video_buffer = io.BytesIO(await video_file.read())
+        encryption_result = await loop.run_in_executor(
+            _get_encryption_executor(),
+            encryption_service.encrypt_stream,
+            video_buffer,
+            encrypted_file_path
+        )
+    else:
+        # Stream large uploads to disk without loading them into memory
+        fd, temp_file_path = tempfile.mkstemp(suffix=".tmp")
+        encrypted_file_path = temp_file_path + ".encrypted"
+        try:
+            with os.fdopen(fd, "wb") as temp_file:
+                await run_in_threadpool(shutil.copyfileobj, video_file.file, temp_file)
+            
+            # Encrypt the video in a worker process
+            encryption_result = await loop.run_in_executor(
+                _get_encryption_executor(),
+                encryption_service.encrypt_file,
+                temp_file_path,
+                encrypted_file_path
+            )
+        finally:
+            # Never leave the plaintext upload on disk, even if the copy or
+            # encryption failed
+            await run_in_threadpool(encryption_service.secure_delete_file, temp_file_path)
     
     # Store encryption key securely (associated with user)
     security_db.store_encryption_key(
@@ -341,9 +404,6 @@ async def encrypt_video(
         encrypted_key=encryption_result["key"]
     )
     
-    # Clean up original temp file
-    encryption_service.secure_delete_file(temp_file_path)
-    
     security_db.log_security_event(
         user_id=user_data["user_id"],
         action="video_encrypted",
@@ -433,11 +493,19 @@ async def validate_api_key(api_key: str):
 @app.get("/security/health")
 async def security_health():
     """Check security system health."""
+    global _health_timestamp_cache
+    now = time.monotonic()
+    if now - _health_timestamp_cache[0] > HEALTH_TIMESTAMP_TTL:
+        _health_timestamp_cache = (now, datetime.now().isoformat())
+    
+    # Security events the log writer had to drop mean the audit trail has gaps
+    database_status = "degraded" if security_db.dropped_security_events else "online"
+    
     return {
-        "status": "healthy",
-        "timestamp": datetime.now().isoformat(),
+        "status": "healthy" if database_status == "online" else "degraded",
+        "timestamp": _health_timestamp_cache[1],
         "services": {
-            "database": "online",
+            "database": database_status,
             "encryption": "online",
             "authentication": "online"
         }
@@ -4,214 +4,762 @@ Handles security-related database operations including logs, privacy settings, a
 """
 
 import sqlite3
+import itertools
 import json
+import logging
+import os
+import pathlib
+import queue
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from typing import Optional, List, Dict, Any
-import hashlib
+from typing import Optional, List, Dict, Any, BinaryIO, Iterator, Tuple
 import secrets
+from cachetools import TLRUCache, TTLCache
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+# Privacy settings change rarely; cache them per user. Invalidation is
+# in-process only, so multi-process deployments need a shared invalidation
+# channel or a shorter TTL.
+PRIVACY_SETTINGS_CACHE_SIZE = 10000
+PRIVACY_SETTINGS_CACHE_TTL = 300  # seconds
+
+# Valid sessions are cached for at most this long, and never past their
+# expires_at. A deactivated session can stay valid in the cache for up to
+# SESSION_CACHE_TTL seconds.
+SESSION_CACHE_SIZE = 50000
+SESSION_CACHE_TTL = 60  # seconds
+
+# Session last_activity updates are buffered and written in batches, at most
+# this many seconds late or as soon as this many sessions are pending
+ACTIVITY_FLUSH_INTERVAL = 2.0
+ACTIVITY_FLUSH_THRESHOLD = 500
+
+# log_security_event only enqueues; a single writer thread commits queued
+# events in transactions of up to this many rows
+LOG_WRITE_BATCH_SIZE = 500
+
+# Attempts at writing a batch while the database is busy before the writer
+# falls back to writing its events one at a time
+LOG_WRITE_RETRIES = 3
+
+# Stored in PRAGMA user_version once the schema has been created; bump it
+# whenever SCHEMA_DDL or LOG_PARTITION_DDL changes
+SCHEMA_VERSION = 2
+
+# security_logs is split into one database file per (UTC) month, attached to
+# a connection on first use. SQLite allows 10 attached databases by default;
+# the least recently used partitions are detached beyond this many.
+MAX_ATTACHED_LOG_PARTITIONS = 6
+
+# How often a caller waiting for a pooled connection checks whether the
+# pool has been closed, in seconds
+POOL_CHECKOUT_POLL_INTERVAL = 0.5
+
+# Attempts at creating a new partition while another process holds it locked
+PARTITION_BOOTSTRAP_RETRIES = 5
+
+# Read-only snapshots (see attach_read_only) take up the remaining slots
+MAX_READ_ONLY_SNAPSHOTS = 4
+
+# Static advice attached to every security audit report
+_SECURITY_RECOMMENDATIONS = (
+    "Enable two-factor authentication for all users",
+    "Regular security log monitoring",
+    "Implement rate limiting for API endpoints",
+    "Regular backup and encryption key rotation"
+)
+
+# Whole schema, run as one script in a single transaction. init_database sets
+# user_version afterwards, once any legacy security_logs rows are migrated.
+SCHEMA_DDL = """
+    BEGIN;
+    
+    -- Registry of monthly security_logs partitions (see LOG_PARTITION_DDL)
+    CREATE TABLE IF NOT EXISTS log_partitions (
+        month TEXT PRIMARY KEY
+    );
+    
+    -- PrivacySettings table
+    CREATE TABLE IF NOT EXISTS privacy_settings (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id TEXT NOT NULL,
+        setting_name TEXT NOT NULL,
+        value TEXT NOT NULL,
+        updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE(user_id, setting_name)
+    );
+    
+    -- ComplianceReports table
+    CREATE TABLE IF NOT EXISTS compliance_reports (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        report_type TEXT NOT NULL,
+        data TEXT NOT NULL,
+        generated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        status TEXT DEFAULT 'pending',
+        user_id TEXT,
+        file_path TEXT
+    );
+    
+    -- DataDeletionRequests table
+    CREATE TABLE IF NOT EXISTS data_deletion_requests (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id TEXT NOT NULL,
+        request_date DATETIME DEFAULT CURRENT_TIMESTAMP,
+        status TEXT DEFAULT 'pending',
+        completed_date DATETIME,
+        deletion_type TEXT,
+        verification_token TEXT,
+        reason TEXT
+    );
+    
+    -- UserSessions table for security monitoring
+    CREATE TABLE IF NOT EXISTS user_sessions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id TEXT NOT NULL,
+        session_token TEXT UNIQUE NOT NULL,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        expires_at DATETIME NOT NULL,
+        last_activity DATETIME DEFAULT CURRENT_TIMESTAMP,
+        ip_address TEXT,
+        user_agent TEXT,
+        is_active BOOLEAN DEFAULT 1
+    );
+    
+    -- EncryptionKeys table
+    CREATE TABLE IF NOT EXISTS encryption_keys (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id TEXT NOT NULL,
+        key_id TEXT UNIQUE NOT NULL,
+        encrypted_key TEXT NOT NULL,
+        key_type TEXT NOT NULL,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        expires_at DATETIME,
+        is_active BOOLEAN DEFAULT 1
+    );
+    
+    -- TwoFactorAuth table
+    CREATE TABLE IF NOT EXISTS two_factor_auth (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id TEXT UNIQUE NOT NULL,
+        secret_key TEXT NOT NULL,
+        backup_codes TEXT,
+        is_enabled BOOLEAN DEFAULT 0,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        last_used DATETIME
+    );
+    
+    -- Indexes for the hot lookup paths. user_sessions.session_token and
+    -- privacy_settings(user_id, setting_name) are already covered by their
+    -- UNIQUE constraints.
+    CREATE INDEX IF NOT EXISTS idx_encryption_keys_user_type
+    ON encryption_keys(user_id, key_type, is_active, created_at DESC);
+    
+    CREATE INDEX IF NOT EXISTS idx_data_deletion_requests_user
+    ON data_deletion_requests(user_id);
+    
+    COMMIT;
+"""
+
+# Schema of one monthly security_logs partition, formatted with its schema name
+LOG_PARTITION_DDL = """
+    BEGIN;
+    
+    CREATE TABLE IF NOT EXISTS {schema}.security_logs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id TEXT NOT NULL,
+        action TEXT NOT NULL,
+        ip_address TEXT,
+        user_agent TEXT,
+        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+        risk_score INTEGER DEFAULT 0,
+        details TEXT,
+        session_id TEXT
+    );
+    
+    CREATE INDEX IF NOT EXISTS {schema}.idx_security_logs_user_timestamp
+    ON security_logs(user_id, timestamp DESC);
+    
+    CREATE INDEX IF NOT EXISTS {schema}.idx_security_logs_timestamp
+    ON security_logs(timestamp);
+    
+    PRAGMA {schema}.user_version = {version};
+    
+    COMMIT;
+"""
+
+
+def _log_timestamp() -> str:
+    """Current UTC time in the format of SQLite's CURRENT_TIMESTAMP."""
+    return datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _session_ttu(_session_token: str, value: tuple, now: float) -> float:
+    """Expiry time for a cached (user_id, seconds_left) session entry."""
+    return now + min(SESSION_CACHE_TTL, value[1])
+
+
+def _json_dumps(value: Any) -> str:
+    """Serialize a value to a JSON string, using orjson when it is installed."""
+    return _json_dumps_bytes(value).decode()
+
+
+def _json_dumps_bytes(value: Any) -> bytes:
+    """Serialize a value to UTF-8 JSON bytes; orjson produces these directly."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            # orjson rejects some values json accepts, e.g. integers beyond 64 bits
+            pass
+    return json.dumps(value).encode()
+
+
+def _build_security_log_queries() -> tuple:
+    """Build the log query template (formatted with a partition's schema name) for
+    every combination of filters, indexed by a 3-bit mask."""
+    queries = []
+    for mask in range(8):
+        query = "SELECT * FROM {schema}.security_logs WHERE 1=1"
+        if mask & 4:
+            query += " AND user_id = ?"
+        if mask & 2:
+            query += " AND timestamp >= ?"
+        if mask & 1:
+            query += " AND timestamp <= ?"
+        queries.append(query + " ORDER BY timestamp DESC LIMIT ?")
+    return tuple(queries)
+
+
+# Fixed statement strings so each variant is prepared once per connection
+# and partition
+SECURITY_LOG_QUERIES = _build_security_log_queries()
+
+
+class PooledConnection(sqlite3.Connection):
+    """SQLite connection that tracks the log partitions attached to it."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Schema names in least- to most-recently used order
+        self.attached_partitions: "OrderedDict[str, None]" = OrderedDict()
+        # Read-only snapshots attached to this connection: alias -> URI
+        self.attached_snapshots: Dict[str, str] = {}
+
+
+class ConnectionPool:
+    """Fixed-size, thread-safe pool of SQLite connections to one database."""
+
+    def __init__(self, db_path: str, size: int = 5):
+        self.db_path = db_path
+        # An in-memory database only exists inside its connection, so every
+        # caller has to share a single one
+        if db_path == ":memory:":
+            size = 1
+        self._connections: "queue.Queue[sqlite3.Connection]" = queue.Queue(maxsize=size)
+        self._closed = False
+        # Orders check-ins against close(), so no connection is returned to
+        # the queue after it has been drained
+        self._close_lock = threading.Lock()
+        for _ in range(size):
+            self._connections.put(self._create_connection())
+
+    def _create_connection(self) -> sqlite3.Connection:
+        """Open a connection with per-connection performance pragmas applied."""
+        # Autocommit: single statements commit on their own without the module
+        # wrapping each one in BEGIN/COMMIT; multi-statement writes open their
+        # transaction explicitly and end it with conn.commit(). Repeated SQL
+        # strings are compiled once per connection by the statement cache.
+        # uri=True lets attach_read_only open snapshots with file: URI flags;
+        # plain paths are unaffected
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, cached_statements=256,
+                               isolation_level=None, factory=PooledConnection, uri=True)
+        conn.row_factory = sqlite3.Row
+        # Only takes effect on a new, empty database, so it has to precede the
+        # journal_mode change below (which writes the database header)
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        # WAL lets readers run alongside the writer and avoids an fsync per
+        # commit. The mode is persistent, but pooled connections are opened
+        # before the schema exists, so each one sets it. sqlite3.connect's
+        # default 5 s timeout already acts as busy_timeout.
+        conn.execute("PRAGMA journal_mode=WAL").fetchone()
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-64000")
+        conn.execute("PRAGMA mmap_size=268435456")
+        return conn
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        """Check out a connection, rolling back uncommitted work on error."""
+        conn = self._checkout()
+        try:
+            yield conn
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            with self._close_lock:
+                if self._closed:
+                    conn.close()
+                else:
+                    self._connections.put(conn)
+
+    def _checkout(self) -> sqlite3.Connection:
+        """Wait for a free connection; raises once the pool is closed."""
+        while True:
+            if self._closed:
+                raise sqlite3.ProgrammingError("Cannot operate on a closed connection pool.")
+            try:
+                # Wake up now and then, so waiters notice close()
+                return self._connections.get(timeout=POOL_CHECKOUT_POLL_INTERVAL)
+            except queue.Empty:
+                pass
+
+    def close(self):
+        """Close all pooled connections, refreshing planner statistics first.
+        Connections checked out at the time are closed when they come back."""
+        with self._close_lock:
+            self._closed = True
+        while not self._connections.empty():
+            conn = self._connections.get_nowait()
+            # Read-only snapshots cannot take optimize's writes; a connection
+            # may still hold one detached since it was last used
+            for alias in conn.attached_snapshots:
+                conn.execute(f"DETACH DATABASE {alias}")
+            # Cheap unless statistics are stale; keeps index choice on
+            # security_logs sensible as the table grows
+            conn.execute("PRAGMA optimize")
+            conn.close()
+
 
 class SecurityDatabase:
-    def __init__(self, db_path: str = "security.db"):
+    def __init__(self, db_path: str = "security.db", pool_size: int = 5, reports_dir: str = None):
         self.db_path = db_path
+        self.reports_dir = reports_dir
+        self._pool = ConnectionPool(db_path, pool_size)
+        self._activity_buffer: Dict[str, str] = {}
+        self._activity_lock = threading.Lock()
+        self._partition_bootstrap_lock = threading.Lock()
+        self._activity_timer: Optional[threading.Timer] = None
+        self._privacy_cache = TTLCache(maxsize=PRIVACY_SETTINGS_CACHE_SIZE, ttl=PRIVACY_SETTINGS_CACHE_TTL)
+        self._privacy_cache_lock = threading.Lock()
+        self._session_cache = TLRUCache(maxsize=SESSION_CACHE_SIZE, ttu=_session_ttu)
+        self._session_cache_lock = threading.Lock()
+        self._log_months: set = set()
+        self._read_only_snapshots: Dict[str, str] = {}
         self.init_database()
+        # Events the writer could not write; reported by close() and the health check
+        self.dropped_security_events = 0
+        self._log_queue: "queue.Queue[Optional[Dict[str, Any]]]" = queue.Queue()
+        self._log_writer_thread = threading.Thread(target=self._log_writer, daemon=True)
+        self._log_writer_thread.start()
+
+    def _conn(self):
+        """Borrow a pooled connection for the duration of a with-block."""
+        return self._pool.connection()
+
+    def close(self):
+        """Flush pending writes and close all database connections."""
+        # The writer drains everything queued ahead of the None sentinel
+        self._log_queue.put(None)
+        self._log_writer_thread.join()
+        self.flush_session_activity()
+        self._pool.close()
+        if self.dropped_security_events:
+            logger.error("%d security events could not be written", self.dropped_security_events)
 
     def init_database(self):
         """Initialize security database with required tables."""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # SecurityLogs table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS security_logs (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id TEXT NOT NULL,
-                action TEXT NOT NULL,
-                ip_address TEXT,
-                user_agent TEXT,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                risk_score INTEGER DEFAULT 0,
-                details TEXT,
-                session_id TEXT
-            )
-        ''')
-        
-        # PrivacySettings table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS privacy_settings (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id TEXT NOT NULL,
-                setting_name TEXT NOT NULL,
-                value TEXT NOT NULL,
-                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(user_id, setting_name)
-            )
-        ''')
-        
-        # ComplianceReports table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS compliance_reports (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                report_type TEXT NOT NULL,
-                data TEXT NOT NULL,
-                generated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                status TEXT DEFAULT 'pending',
-                user_id TEXT,
-                file_path TEXT
-            )
-        ''')
-        
-        # DataDeletionRequests table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS data_deletion_requests (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id TEXT NOT NULL,
-                request_date DATETIME DEFAULT CURRENT_TIMESTAMP,
-                status TEXT DEFAULT 'pending',
-                completed_date DATETIME,
-                deletion_type TEXT,
-                verification_token TEXT,
-                reason TEXT
-            )
-        ''')
-        
-        # UserSessions table for security monitoring
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_sessions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id TEXT NOT NULL,
-                session_token TEXT UNIQUE NOT NULL,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                expires_at DATETIME NOT NULL,
-                last_activity DATETIME DEFAULT CURRENT_TIMESTAMP,
-                ip_address TEXT,
-                user_agent TEXT,
-                is_active BOOLEAN DEFAULT 1
-            )
-        ''')
-        
-        # EncryptionKeys table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS encryption_keys (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id TEXT NOT NULL,
-                key_id TEXT UNIQUE NOT NULL,
-                encrypted_key TEXT NOT NULL,
-                key_type TEXT NOT NULL,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                expires_at DATETIME,
-                is_active BOOLEAN DEFAULT 1
-            )
-        ''')
-        
-        # TwoFactorAuth table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS two_factor_auth (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id TEXT UNIQUE NOT NULL,
-                secret_key TEXT NOT NULL,
-                backup_codes TEXT,
-                is_enabled BOOLEAN DEFAULT 0,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                last_used DATETIME
-            )
-        ''')
+        with self._conn() as conn:
+            cursor = conn.cursor()
+            
+            # Skip all DDL when the database already has the current schema
+            cursor.execute("PRAGMA user_version")
+            if cursor.fetchone()[0] == SCHEMA_VERSION:
+                return
+            
+            cursor.executescript(SCHEMA_DDL)
+            self._migrate_security_logs(conn)
+            cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            cursor.execute("ANALYZE")
+
+    def _migrate_security_logs(self, conn: PooledConnection):
+        """Move rows of the pre-partitioning main.security_logs table into their monthly partitions."""
+        if conn.execute(
+            "SELECT 1 FROM main.sqlite_master WHERE type = 'table' AND name = 'security_logs'"
+        ).fetchone() is None:
+            return
         
-        conn.commit()
-        conn.close()
+        months = [row[0] for row in conn.execute(
+            "SELECT DISTINCT strftime('%Y_%m', COALESCE(timestamp, CURRENT_TIMESTAMP)) FROM main.security_logs"
+        )]
+        for month in months:
+            schema = self._attach_log_partition(conn, month)
+            # Copy and delete together so an interrupted migration resumes
+            # without duplicating the months it already moved
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(f'''
+                INSERT INTO {schema}.security_logs
+                (user_id, action, ip_address, user_agent, timestamp, risk_score, details, session_id)
+                SELECT user_id, action, ip_address, user_agent,
+                       COALESCE(timestamp, CURRENT_TIMESTAMP), risk_score, details, session_id
+                FROM main.security_logs
+                WHERE strftime('%Y_%m', COALESCE(timestamp, CURRENT_TIMESTAMP)) = ?
+                ORDER BY id
+            ''', (month,))
+            conn.execute('''
+                DELETE FROM main.security_logs
+                WHERE strftime('%Y_%m', COALESCE(timestamp, CURRENT_TIMESTAMP)) = ?
+            ''', (month,))
+            conn.execute("INSERT OR IGNORE INTO log_partitions (month) VALUES (?)", (month,))
+            conn.commit()
+        
+        # Its indexes go with it
+        conn.execute("DROP TABLE main.security_logs")
 
     def log_security_event(self, user_id: str, action: str, ip_address: str = None, 
                           user_agent: str = None, risk_score: int = 0, 
                           details: Dict = None, session_id: str = None):
-        """Log a security event."""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        """Queue a security event for the background writer (see flush_security_logs)."""
+        # Serialize here so unserializable details fail in the caller rather
+        # than in the writer thread
+        details_json = _json_dumps(details) if details else None
+        self._log_queue.put({
+            "timestamp": _log_timestamp(),
+            "user_id": user_id,
+            "action": action,
+            "ip_address": ip_address,
+            "user_agent": user_agent,
+            "risk_score": risk_score,
+            "details_json": details_json,
+            "session_id": session_id
+        })
+
+    def _log_writer(self):
+        """Write queued events in batches, one transaction each, until close() sends None."""
+        while True:
+            events = [self._log_queue.get()]
+            # Block for the first event, then take whatever else is already queued
+            while events[-1] is not None and len(events) < LOG_WRITE_BATCH_SIZE:
+                try:
+                    events.append(self._log_queue.get_nowait())
+                except queue.Empty:
+                    break
+            
+            stop = events[-1] is None
+            if stop:
+                events.pop()
+            
+            try:
+                if events:
+                    self._write_queued_events(events)
+            finally:
+                for _ in range(len(events) + stop):
+                    self._log_queue.task_done()
+            
+            if stop:
+                return
+
+    def _write_queued_events(self, events: List[Dict[str, Any]]):
+        """Write a batch from the queue, retrying while the database is busy and
+        falling back to one event at a time if the batch keeps failing."""
+        for attempt in range(LOG_WRITE_RETRIES):
+            try:
+                self.log_security_events(events)
+                return
+            except sqlite3.OperationalError as e:
+                logger.warning("Security log write failed (attempt %d/%d): %s", attempt + 1, LOG_WRITE_RETRIES, e)
+                if attempt < LOG_WRITE_RETRIES - 1:
+                    time.sleep(0.1 * 2 ** attempt)
+            except Exception as e:
+                logger.warning("Security log write failed: %s", e)
+                break
         
-        details_json = json.dumps(details) if details else None
+        # Only the events that fail on their own are lost
+        for event in events:
+            try:
+                self.log_security_events([event])
+            except Exception:
+                self.dropped_security_events += 1
+                logger.exception("Dropped security event %r for user %r", event.get("action"), event.get("user_id"))
+
+    def flush_security_logs(self):
+        """Block until every queued security event has been written (or dropped, see dropped_security_events)."""
+        self._log_queue.join()
+
+    def log_security_events(self, events: List[Dict[str, Any]]):
+        """Log many security events (dicts keyed like log_security_event's arguments,
+        plus an optional "timestamp") in one transaction."""
+        # Events carry the time they were queued; each row goes to the
+        # partition of its own month
+        now = _log_timestamp()
+        rows_by_month: Dict[str, list] = {}
+        for event in events:
+            timestamp = event.get("timestamp") or now
+            rows_by_month.setdefault(timestamp[:7].replace("-", "_"), []).append((
+                event["user_id"],
+                event["action"],
+                event.get("ip_address"),
+                event.get("user_agent"),
+                event.get("risk_score", 0),
+                event["details_json"] if "details_json" in event else (
+                    _json_dumps(event["details"]) if event.get("details") else None
+                ),
+                event.get("session_id"),
+                timestamp
+            ))
         
-        cursor.execute('''
-            INSERT INTO security_logs 
-            (user_id, action, ip_address, user_agent, risk_score, details, session_id)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (user_id, action, ip_address, user_agent, risk_score, details_json, session_id))
+        with self._conn() as conn:
+            cursor = conn.cursor()
+            # ATTACH is not allowed inside a transaction
+            schemas = {month: self._attach_log_partition(conn, month) for month in rows_by_month}
+            
+            # Take the write lock up front rather than on the first INSERT
+            cursor.execute("BEGIN IMMEDIATE")
+            for month, rows in rows_by_month.items():
+                if month not in self._log_months:
+                    cursor.execute("INSERT OR IGNORE INTO log_partitions (month) VALUES (?)", (month,))
+                
+                cursor.executemany(f'''
+                    INSERT INTO {schemas[month]}.security_logs 
+                    (user_id, action, ip_address, user_agent, risk_score, details, session_id, timestamp)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ''', rows)
+            
+            conn.commit()
+        
+        self._log_months.update(rows_by_month)
+
+    def _log_partition_path(self, month: str) -> str:
+        """Database file holding the security logs of one month (YYYY_MM)."""
+        if self.db_path == ":memory:":
+            return ":memory:"
+        return f"{os.path.splitext(self.db_path)[0]}_logs_{month}.db"
+
+    def _attach_log_partition(self, conn: PooledConnection, month: str) -> str:
+        """Attach a month's log partition to conn (creating it if needed) and return its schema name."""
+        schema = f"logs_{month}"
+        if schema in conn.attached_partitions:
+            conn.attached_partitions.move_to_end(schema)
+            return schema
         
-        conn.commit()
-        conn.close()
+        # In-memory partitions would be lost on DETACH, so they are never evicted
+        if len(conn.attached_partitions) >= MAX_ATTACHED_LOG_PARTITIONS and self.db_path != ":memory:":
+            evicted, _ = conn.attached_partitions.popitem(last=False)
+            conn.execute(f"DETACH DATABASE {evicted}")
+        
+        conn.execute(f"ATTACH DATABASE ? AS {schema}", (self._log_partition_path(month),))
+        conn.attached_partitions[schema] = None
+        
+        if conn.execute(f"PRAGMA {schema}.user_version").fetchone()[0] != SCHEMA_VERSION:
+            self._bootstrap_log_partition(conn, schema)
+        conn.execute(f"PRAGMA {schema}.synchronous=NORMAL")
+        
+        return schema
+
+    def _bootstrap_log_partition(self, conn: PooledConnection, schema: str):
+        """Create a freshly attached partition's schema, one connection at a time."""
+        # Switching to WAL needs the file to itself, so concurrent first
+        # attaches from pooled connections would fail with "database is locked"
+        with self._partition_bootstrap_lock:
+            for attempt in range(PARTITION_BOOTSTRAP_RETRIES):
+                try:
+                    # Another connection (or process) may have got here first
+                    if conn.execute(f"PRAGMA {schema}.user_version").fetchone()[0] == SCHEMA_VERSION:
+                        return
+                    conn.execute(f"PRAGMA {schema}.auto_vacuum=INCREMENTAL")
+                    conn.execute(f"PRAGMA {schema}.journal_mode=WAL")
+                    conn.executescript(LOG_PARTITION_DDL.format(schema=schema, version=SCHEMA_VERSION))
+                    return
+                except sqlite3.OperationalError as e:
+                    # Only other processes can still hold the file here
+                    if conn.in_transaction:
+                        conn.rollback()
+                    if "locked" not in str(e) or attempt == PARTITION_BOOTSTRAP_RETRIES - 1:
+                        raise
+                    time.sleep(0.05 * (attempt + 1))
+
+    def _log_partition_months(self, conn: PooledConnection, start_date: datetime = None,
+                              end_date: datetime = None) -> List[str]:
+        """Months (YYYY_MM) with a log partition between start_date and end_date, newest first."""
+        cursor = conn.execute('''
+            SELECT month FROM log_partitions
+            WHERE month BETWEEN ? AND ?
+            ORDER BY month DESC
+        ''', (start_date.strftime("%Y_%m") if start_date else "",
+              end_date.strftime("%Y_%m") if end_date else "9999_99"))
+        return [row["month"] for row in cursor]
+
+    def attach_read_only(self, path: str, alias: str):
+        """Include the security_logs of another database file (e.g. an archived
+        export) in log queries and audits, opened read-only without copying it."""
+        if not alias.isidentifier() or alias.lower() in ("main", "temp") or alias.startswith("logs_"):
+            raise ValueError(f"Invalid snapshot alias: {alias!r}")
+        if alias not in self._read_only_snapshots and len(self._read_only_snapshots) >= MAX_READ_ONLY_SNAPSHOTS:
+            raise ValueError(f"At most {MAX_READ_ONLY_SNAPSHOTS} read-only snapshots can be attached")
+        
+        # immutable=1 tells SQLite the file cannot change, so it skips locking
+        # and change detection entirely; snapshots must not be written to
+        self._read_only_snapshots[alias] = pathlib.Path(path).resolve().as_uri() + "?mode=ro&immutable=1"
+
+    def detach_read_only(self, alias: str):
+        """Stop including a snapshot added with attach_read_only."""
+        self._read_only_snapshots.pop(alias, None)
+
+    def _attach_read_only_snapshots(self, conn: PooledConnection) -> List[str]:
+        """Bring conn's attached snapshots in line with the registered ones and return their aliases."""
+        for alias, uri in list(conn.attached_snapshots.items()):
+            if self._read_only_snapshots.get(alias) != uri:
+                conn.execute(f"DETACH DATABASE {alias}")
+                del conn.attached_snapshots[alias]
+        
+        for alias, uri in self._read_only_snapshots.items():
+            if alias not in conn.attached_snapshots:
+                conn.execute(f"ATTACH DATABASE ? AS {alias}", (uri,))
+                conn.attached_snapshots[alias] = uri
+        
+        return list(conn.attached_snapshots)
 
     def get_security_logs(self, user_id: str = None, limit: int = 100, 
                          start_date: datetime = None, end_date: datetime = None) -> List[Dict]:
         """Retrieve security logs with optional filtering."""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        return list(self.iter_security_logs(user_id, limit, start_date, end_date))
+
+    def iter_security_logs(self, user_id: str = None, limit: int = 100, 
+                          start_date: datetime = None, end_date: datetime = None) -> Iterator[Dict]:
+        """Stream security logs one dict at a time, newest first, visiting one monthly
+        partition after another. Each partition's rows are fetched before any is
+        yielded, so no pooled connection is held while the caller consumes them."""
+        # Make events logged by this process visible before reading
+        self.flush_security_logs()
         
-        query = "SELECT * FROM security_logs WHERE 1=1"
+        query_key = (bool(user_id) << 2) | (bool(start_date) << 1) | bool(end_date)
         params = []
         
         if user_id:
-            query += " AND user_id = ?"
             params.append(user_id)
         
         if start_date:
-            query += " AND timestamp >= ?"
             params.append(start_date.isoformat())
         
         if end_date:
-            query += " AND timestamp <= ?"
             params.append(end_date.isoformat())
         
-        query += " ORDER BY timestamp DESC LIMIT ?"
-        params.append(limit)
+        # Live partitions newest first, then any read-only snapshots
+        with self._conn() as conn:
+            sources = [(False, month) for month in self._log_partition_months(conn, start_date, end_date)]
+        sources += [(True, alias) for alias in list(self._read_only_snapshots)]
+        
+        remaining = limit
+        for is_snapshot, name in sources:
+            if remaining <= 0:
+                break
+            
+            with self._conn() as conn:
+                if is_snapshot:
+                    # Detached since the list was taken
+                    if name not in self._attach_read_only_snapshots(conn):
+                        continue
+                    schema = name
+                else:
+                    schema = self._attach_log_partition(conn, name)
+                rows = conn.execute(
+                    SECURITY_LOG_QUERIES[query_key].format(schema=schema), params + [remaining]
+                ).fetchall()
+            
+            remaining -= len(rows)
+            for row in rows:
+                yield dict(row)
+
+    def security_log_stats(self, user_id: str) -> Tuple[int, Optional[int]]:
+        """Count a user's security events and find their lowest risk score, aggregated
+        in SQL per partition rather than by fetching the rows."""
+        # Make events logged by this process visible before reading
+        self.flush_security_logs()
         
-        cursor.execute(query, params)
-        logs = cursor.fetchall()
-        conn.close()
+        count, min_risk_score = 0, None
+        with self._conn() as conn:
+            schemas = itertools.chain(
+                (self._attach_log_partition(conn, month) for month in self._log_partition_months(conn)),
+                self._attach_read_only_snapshots(conn)
+            )
+            for schema in schemas:
+                partition_count, partition_min = conn.execute(
+                    f"SELECT COUNT(*), MIN(risk_score) FROM {schema}.security_logs WHERE user_id = ?",
+                    (user_id,)
+                ).fetchone()
+                count += partition_count
+                if partition_min is not None and (min_risk_score is None or partition_min < min_risk_score):
+                    min_risk_score = partition_min
         
-        return [dict(zip([col[0] for col in cursor.description], log)) for log in logs]
+        return count, min_risk_score
 
     def set_privacy_setting(self, user_id: str, setting_name: str, value: str):
         """Set or update a privacy setting for a user."""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT OR REPLACE INTO privacy_settings (user_id, setting_name, value, updated_at)
-            VALUES (?, ?, ?, CURRENT_TIMESTAMP)
-        ''', (user_id, setting_name, value))
+        with self._conn() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                INSERT INTO privacy_settings (user_id, setting_name, value)
+                VALUES (?, ?, ?)
+                ON CONFLICT(user_id, setting_name)
+                DO UPDATE SET value = excluded.value, updated_at = CURRENT_TIMESTAMP
+            ''', (user_id, setting_name, value))
+            
+            conn.commit()
         
-        conn.commit()
-        conn.close()
+        with self._privacy_cache_lock:
+            self._privacy_cache.pop(user_id, None)
 
     def get_privacy_settings(self, user_id: str) -> Dict[str, str]:
         """Get all privacy settings for a user."""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        with self._privacy_cache_lock:
+            cached = self._privacy_cache.get(user_id)
+        if cached is not None:
+            return dict(cached)
         
-        cursor.execute('''
-            SELECT setting_name, value FROM privacy_settings 
-            WHERE user_id = ?
-        ''', (user_id,))
+        with self._conn() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                SELECT setting_name, value FROM privacy_settings 
+                WHERE user_id = ?
+            ''', (user_id,))
+            
+            settings = {row["setting_name"]: row["value"] for row in cursor}
         
-        settings = cursor.fetchall()
-        conn.close()
+        with self._privacy_cache_lock:
+            self._privacy_cache[user_id] = settings
         
-        return {setting[0]: setting[1] for setting in settings}
+        return dict(settings)
 
     def create_data_deletion_request(self, user_id: str, deletion_type: str = "full", 
                                    reason: str = None) -> str:
         """Create a data deletion request."""
         verification_token = secrets.token_urlsafe(32)
         
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT INTO data_deletion_requests 
-            (user_id, deletion_type, verification_token, reason)
-            VALUES (?, ?, ?, ?)
-        ''', (user_id, deletion_type, verification_token, reason))
-        
-        request_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
+        with self._conn() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                INSERT INTO data_deletion_requests 
+                (user_id, deletion_type, verification_token, reason)
+                VALUES (?, ?, ?, ?)
+                RETURNING id
+            ''', (user_id, deletion_type, verification_token, reason))
+            
+            request_id = cursor.fetchone()["id"]
+            conn.commit()
         
         self.log_security_event(user_id, "data_deletion_requested", 
                                details={"request_id": request_id, "type": deletion_type})
@@ -220,211 +768,318 @@ class SecurityDatabase:
 
     def process_data_deletion_request(self, request_id: int, status: str = "completed"):
         """Process a data deletion request."""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        if status == "completed":
-            cursor.execute('''
-                UPDATE data_deletion_requests 
-                SET status = ?, completed_date = CURRENT_TIMESTAMP
-                WHERE id = ?
-            ''', (status, request_id))
-        else:
-            cursor.execute('''
-                UPDATE data_deletion_requests 
-                SET status = ?
-                WHERE id = ?
-            ''', (status, request_id))
-        
-        conn.commit()
-        conn.close()
+        with self._conn() as conn:
+            cursor = conn.cursor()
+            
+            if status == "completed":
+                cursor.execute('''
+                    UPDATE data_deletion_requests 
+                    SET status = ?, completed_date = CURRENT_TIMESTAMP
+                    WHERE id = ?
+                ''', (status, request_id))
+            else:
+                cursor.execute('''
+                    UPDATE data_deletion_requests 
+                    SET status = ?
+                    WHERE id = ?
+                ''', (status, request_id))
+            
+            conn.commit()
 
     def generate_compliance_report(self, report_type: str, user_id: str = None) -> int:
         """Generate a compliance report."""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        file_path = None
+        # One UTC timestamp (like the database's) for the whole report
+        report_date = datetime.utcnow().isoformat()
         
-        # Generate report data based on type
+        # Generate report data based on type (before borrowing a connection,
+        # since the generators use the pool themselves)
         if report_type == "gdpr_data_export":
-            data = self._generate_gdpr_export(user_id)
+            # Exports can be large, so they are streamed to a file and only
+            # referenced from the report row
+            file_path = os.path.join(self._get_reports_dir(), f"gdpr_export_{secrets.token_hex(8)}.json")
+            with open(file_path, "wb") as export_file:
+                self._generate_gdpr_export(user_id, export_file, report_date)
+            data = {"export_file": file_path}
         elif report_type == "ccpa_data_summary":
-            data = self._generate_ccpa_summary(user_id)
+            data = self._generate_ccpa_summary(user_id, report_date)
         elif report_type == "security_audit":
-            data = self._generate_security_audit()
+            data = self._generate_security_audit(report_date)
         else:
             data = {"error": "Unknown report type"}
         
-        data_json = json.dumps(data)
+        data_json = _json_dumps(data)
         
-        cursor.execute('''
-            INSERT INTO compliance_reports (report_type, data, user_id)
-            VALUES (?, ?, ?)
-        ''', (report_type, data_json, user_id))
-        
-        report_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
+        with self._conn() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                INSERT INTO compliance_reports (report_type, data, user_id, file_path)
+                VALUES (?, ?, ?, ?)
+                RETURNING id
+            ''', (report_type, data_json, user_id, file_path))
+            
+            report_id = cursor.fetchone()["id"]
+            conn.commit()
         
         return report_id
 
-    def _generate_gdpr_export(self, user_id: str) -> Dict:
-        """Generate GDPR data export for a user."""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    def _get_reports_dir(self) -> str:
+        """Directory for report files: next to the database file by default."""
+        if self.reports_dir is None:
+            if self.db_path == ":memory:":
+                self.reports_dir = tempfile.mkdtemp(prefix="compliance_reports_")
+            else:
+                self.reports_dir = os.path.join(os.path.dirname(os.path.abspath(self.db_path)), "compliance_reports")
+        os.makedirs(self.reports_dir, exist_ok=True)
+        return self.reports_dir
+
+    def _generate_gdpr_export(self, user_id: str, export_file: BinaryIO, export_date: str):
+        """Stream a GDPR data export for a user to export_file as JSON, row by row
+        (written as bytes, so orjson output needs no decode/encode round trip)."""
+        privacy_settings = self.get_privacy_settings(user_id)
         
-        # Collect all user data from various tables
-        user_data = {
-            "user_id": user_id,
-            "export_date": datetime.now().isoformat(),
-            "privacy_settings": self.get_privacy_settings(user_id),
-            "security_logs": self.get_security_logs(user_id, limit=1000),
-            "data_requests": []
-        }
+        export_file.write(b'{"user_id": ' + _json_dumps_bytes(user_id))
+        export_file.write(b', "export_date": ' + _json_dumps_bytes(export_date))
+        export_file.write(b', "privacy_settings": ' + _json_dumps_bytes(privacy_settings))
+        
+        export_file.write(b', "security_logs": [')
+        for index, log in enumerate(self.iter_security_logs(user_id, limit=1000)):
+            if index:
+                export_file.write(b", ")
+            export_file.write(_json_dumps_bytes(log))
         
         # Get data deletion requests
-        cursor.execute('''
-            SELECT * FROM data_deletion_requests WHERE user_id = ?
-        ''', (user_id,))
-        requests = cursor.fetchall()
-        user_data["data_requests"] = [dict(zip([col[0] for col in cursor.description], req)) for req in requests]
+        export_file.write(b'], "data_requests": [')
+        with self._conn() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                SELECT * FROM data_deletion_requests WHERE user_id = ?
+            ''', (user_id,))
+            for index, request in enumerate(cursor):
+                if index:
+                    export_file.write(b", ")
+                export_file.write(_json_dumps_bytes(dict(request)))
         
-        conn.close()
-        return user_data
+        export_file.write(b"]}")
 
-    def _generate_ccpa_summary(self, user_id: str) -> Dict:
+    def _generate_ccpa_summary(self, user_id: str, summary_date: str) -> Dict:
         """Generate CCPA data summary for a user."""
         privacy_settings = self.get_privacy_settings(user_id)
         security_logs = self.get_security_logs(user_id, limit=100)
         
         return {
             "user_id": user_id,
-            "summary_date": datetime.now().isoformat(),
+            "summary_date": summary_date,
             "data_categories": ["personal_info", "video_data", "analysis_results"],
             "privacy_settings": privacy_settings,
             "recent_activities": len(security_logs),
             "opt_out_status": privacy_settings.get("data_sharing_opt_out", "false")
         }
 
-    def _generate_security_audit(self) -> Dict:
+    def _generate_security_audit(self, audit_date: str) -> Dict:
         """Generate security audit report."""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # Get security metrics
-        cursor.execute("SELECT COUNT(*) FROM security_logs WHERE timestamp > datetime('now', '-30 days')")
-        recent_events = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(DISTINCT user_id) FROM security_logs WHERE timestamp > datetime('now', '-30 days')")
-        active_users = cursor.fetchone()[0]
+        self.flush_security_logs()
         
-        cursor.execute("SELECT COUNT(*) FROM security_logs WHERE risk_score > 5 AND timestamp > datetime('now', '-30 days')")
-        high_risk_events = cursor.fetchone()[0]
+        with self._conn() as conn:
+            cursor = conn.cursor()
+            
+            # Only the partitions overlapping the 30-day range are touched
+            since = datetime.utcnow() - timedelta(days=30)
+            # (plus any read-only snapshots, which are not partitioned)
+            schemas = [self._attach_log_partition(conn, month) for month in self._log_partition_months(conn, since)]
+            schemas += self._attach_read_only_snapshots(conn)
+            recent_logs = " UNION ALL ".join(
+                [f"SELECT user_id, risk_score FROM {schema}.security_logs "
+                 "WHERE timestamp > datetime('now', '-30 days')"
+                 for schema in schemas]
+                or ["SELECT NULL AS user_id, NULL AS risk_score WHERE 0"]
+            )
+            
+            # Get security metrics in a single pass over the 30-day range
+            cursor.execute(f'''
+                SELECT COUNT(*),
+                       COUNT(DISTINCT user_id),
+                       SUM(CASE WHEN risk_score > 5 THEN 1 ELSE 0 END)
+                FROM ({recent_logs})
+            ''')
+            recent_events, active_users, high_risk_events = cursor.fetchone()
         
-        conn.close()
+        # SUM over no rows is NULL
+        high_risk_events = high_risk_events or 0
         
         return {
-            "audit_date": datetime.now().isoformat(),
+            "audit_date": audit_date,
             "metrics": {
                 "recent_security_events": recent_events,
                 "active_users_30_days": active_users,
                 "high_risk_events": high_risk_events
             },
-            "recommendations": self._generate_security_recommendations()
+            "recommendations": _SECURITY_RECOMMENDATIONS
         }
 
     def _generate_security_recommendations(self) -> List[str]:
         """Generate security recommendations based on current state."""
-        recommendations = [
-            "Enable two-factor authentication for all users",
-            "Regular security log monitoring",
-            "Implement rate limiting for API endpoints",
-            "Regular backup and encryption key rotation"
-        ]
-        return recommendations
+        return list(_SECURITY_RECOMMENDATIONS)
 
     def create_user_session(self, user_id: str, ip_address: str = None, 
                            user_agent: str = None, expires_hours: int = 24) -> str:
         """Create a new user session."""
         session_token = secrets.token_urlsafe(64)
-        expires_at = datetime.now() + timedelta(hours=expires_hours)
-        
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
         
-        cursor.execute('''
-            INSERT INTO user_sessions 
-            (user_id, session_token, expires_at, ip_address, user_agent)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (user_id, session_token, expires_at, ip_address, user_agent))
-        
-        conn.commit()
-        conn.close()
+        with self._conn() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                INSERT INTO user_sessions 
+                (user_id, session_token, expires_at, ip_address, user_agent)
+                VALUES (?, ?, datetime('now', ?), ?, ?)
+            ''', (user_id, session_token, f"+{expires_hours} hours", ip_address, user_agent))
+            
+            conn.commit()
         
         self.log_security_event(user_id, "session_created", ip_address, user_agent, 
                                session_id=session_token)
         
         return session_token
 
+    def create_user_sessions(self, user_ids: List[str], ip_addresses: List[str] = None,
+                             user_agent: str = None, expires_hours: int = 24) -> List[str]:
+        """Create a session for each user (with the matching IP address) in one
+        transaction; returns the tokens in the same order."""
+        if ip_addresses is None:
+            ip_addresses = [None] * len(user_ids)
+        session_tokens = [secrets.token_urlsafe(64) for _ in user_ids]
+        expires = f"+{expires_hours} hours"
+        
+        with self._conn() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute("BEGIN")
+            cursor.executemany('''
+                INSERT INTO user_sessions 
+                (user_id, session_token, expires_at, ip_address, user_agent)
+                VALUES (?, ?, datetime('now', ?), ?, ?)
+            ''', [
+                (user_id, session_token, expires, ip_address, user_agent)
+                for user_id, session_token, ip_address in zip(user_ids, session_tokens, ip_addresses)
+            ])
+            
+            conn.commit()
+        
+        self.log_security_events([
+            {"user_id": user_id, "action": "session_created", "ip_address": ip_address,
+             "user_agent": user_agent, "session_id": session_token}
+            for user_id, session_token, ip_address in zip(user_ids, session_tokens, ip_addresses)
+        ])
+        
+        return session_tokens
+
     def validate_session(self, session_token: str) -> Optional[str]:
         """Validate a session token and return user_id if valid."""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        with self._session_cache_lock:
+            cached = self._session_cache.get(session_token)
         
-        cursor.execute('''
-            SELECT user_id FROM user_sessions 
-            WHERE session_token = ? AND expires_at > CURRENT_TIMESTAMP AND is_active = 1
-        ''', (session_token,))
+        if cached is not None:
+            user_id = cached[0]
+        else:
+            with self._conn() as conn:
+                cursor = conn.cursor()
+                
+                cursor.execute('''
+                    SELECT user_id,
+                           (julianday(expires_at) - julianday('now')) * 86400 AS seconds_left
+                    FROM user_sessions 
+                    WHERE session_token = ? AND expires_at > CURRENT_TIMESTAMP AND is_active = 1
+                ''', (session_token,))
+                
+                result = cursor.fetchone()
+            
+            if not result:
+                return None
+            
+            user_id = result["user_id"]
+            with self._session_cache_lock:
+                self._session_cache[session_token] = (user_id, result["seconds_left"])
         
-        result = cursor.fetchone()
+        # Update last activity (buffered, written by flush_session_activity)
+        self._record_session_activity(session_token)
         
-        if result:
-            # Update last activity
-            cursor.execute('''
+        return user_id
+
+    def _record_session_activity(self, session_token: str):
+        """Buffer a last_activity update, scheduling a flush if none is pending."""
+        # Same format as SQLite's CURRENT_TIMESTAMP
+        now = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+        
+        with self._activity_lock:
+            self._activity_buffer[session_token] = now
+            flush_now = len(self._activity_buffer) >= ACTIVITY_FLUSH_THRESHOLD
+            if not flush_now and self._activity_timer is None:
+                self._activity_timer = threading.Timer(ACTIVITY_FLUSH_INTERVAL, self.flush_session_activity)
+                self._activity_timer.daemon = True
+                self._activity_timer.start()
+        
+        if flush_now:
+            self.flush_session_activity()
+
+    def flush_session_activity(self):
+        """Write all buffered session last_activity updates in one transaction."""
+        with self._activity_lock:
+            updates = [(timestamp, token) for token, timestamp in self._activity_buffer.items()]
+            self._activity_buffer = {}
+            if self._activity_timer is not None:
+                self._activity_timer.cancel()
+                self._activity_timer = None
+        
+        if not updates:
+            return
+        
+        with self._conn() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute("BEGIN")
+            cursor.executemany('''
                 UPDATE user_sessions 
-                SET last_activity = CURRENT_TIMESTAMP 
+                SET last_activity = ? 
                 WHERE session_token = ?
-            ''', (session_token,))
+            ''', updates)
+            
             conn.commit()
-            user_id = result[0]
-        else:
-            user_id = None
-        
-        conn.close()
-        return user_id
 
     def store_encryption_key(self, user_id: str, key_type: str, 
                            encrypted_key: str, expires_days: int = None) -> str:
         """Store an encryption key for a user."""
         key_id = secrets.token_urlsafe(16)
-        expires_at = datetime.now() + timedelta(days=expires_days) if expires_days else None
-        
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        # datetime('now', NULL) is NULL, i.e. the key never expires
+        expires_modifier = f"+{expires_days} days" if expires_days else None
         
-        cursor.execute('''
-            INSERT INTO encryption_keys 
-            (user_id, key_id, encrypted_key, key_type, expires_at)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (user_id, key_id, encrypted_key, key_type, expires_at))
-        
-        conn.commit()
-        conn.close()
+        with self._conn() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                INSERT INTO encryption_keys 
+                (user_id, key_id, encrypted_key, key_type, expires_at)
+                VALUES (?, ?, ?, ?, datetime('now', ?))
+            ''', (user_id, key_id, encrypted_key, key_type, expires_modifier))
+            
+            conn.commit()
         
         return key_id
 
     def get_encryption_key(self, user_id: str, key_type: str) -> Optional[str]:
         """Get the active encryption key for a user."""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT encrypted_key FROM encryption_keys 
-            WHERE user_id = ? AND key_type = ? AND is_active = 1
-            AND (expires_at IS NULL OR expires_at > CURRENT_TIMESTAMP)
-            ORDER BY created_at DESC LIMIT 1
-        ''', (user_id, key_type))
-        
-        result = cursor.fetchone()
-        conn.close()
+        with self._conn() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                SELECT encrypted_key FROM encryption_keys 
+                WHERE user_id = ? AND key_type = ? AND is_active = 1
+                AND (expires_at IS NULL OR expires_at > CURRENT_TIMESTAMP)
+                ORDER BY created_at DESC LIMIT 1
+            ''', (user_id, key_type))
+            
+            result = cursor.fetchone()
         
-        return result[0] if result else None
\ No newline at end of file
+        return result["encrypted_key"] if result else None
\ No newline at end of file
@@ -100,7 +100,8 @@ cd ../../..
 # Run security tests
 echo "🧪 Running security tests..."
 cd phases/08-security/backend
-python3 -m pytest security_tests.py -v --tb=short
+# Test classes are independent; run them in parallel, one class per worker
+python3 -m pytest security_tests.py -v --tb=short -n auto --dist=loadscope
 cd ../../..
 
 # Create environment configuration
@@ -4,16 +4,20 @@ SkillMirror Security System Validation Script
 Comprehensive validation of all security features and integrations.
 """
 
+import argparse
+import contextlib
+import functools
+import hmac
+import http.client
+import io
 import os
 import sys
 import time
-import json
-import sqlite3
-import tempfile
-import subprocess
-import requests
-from datetime import datetime
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Optional
 
 # Add backend to path for imports
 sys.path.append(os.path.join(os.path.dirname(__file__), 'backend'))
@@ -27,10 +31,60 @@ except ImportError as e:
     print("Please run setup_security.sh first")
     sys.exit(1)
 
+# (description, method) of every validation test, in definition order
+VALIDATION_TESTS = []
+
+# Keys every encryption result must contain
+FILE_ENCRYPTION_RESULT_KEYS = frozenset({'key', 'file_hash', 'encrypted_file'})
+DATA_ENCRYPTION_RESULT_KEYS = frozenset({'encrypted_data', 'key'})
+
+
+def test(description: str):
+    """Decorator registering a SecuritySystemValidator method as a validation test."""
+    def decorator(func):
+        VALIDATION_TESTS.append((description, func))
+        return func
+    return decorator
+
+
+def file_matches(path: str, expected: bytes, chunk_size: int = 64 * 1024) -> bool:
+    """Compare a file with expected bytes chunk by chunk, without reading it whole."""
+    if os.path.getsize(path) != len(expected):
+        return False
+    
+    expected_view = memoryview(expected)
+    with open(path, 'rb') as f:
+        for offset in range(0, len(expected), chunk_size):
+            if not hmac.compare_digest(f.read(chunk_size), expected_view[offset:offset + chunk_size]):
+                return False
+    return True
+
+
+class ThreadOutput(io.TextIOBase):
+    """Stand-in for sys.stdout that keeps each thread's output in its own buffer."""
+    
+    def __init__(self):
+        self._local = threading.local()
+    
+    def write(self, text: str) -> int:
+        buffer = getattr(self._local, "buffer", None)
+        if buffer is None:
+            buffer = self._local.buffer = io.StringIO()
+        return buffer.write(text)
+    
+    def take(self) -> str:
+        """Return and clear the calling thread's output."""
+        buffer = getattr(self._local, "buffer", None)
+        self._local.buffer = None
+        return buffer.getvalue() if buffer else ""
+
+
 class SecuritySystemValidator:
     """Comprehensive security system validation."""
     
-    def __init__(self):
+    def __init__(self, verbose: bool = False):
+        # Quiet by default: only failing tests' output is shown
+        self.verbose = verbose
         self.passed_tests = 0
         self.total_tests = 0
         self.errors = []
@@ -42,49 +96,49 @@ class SecuritySystemValidator:
         self.totp_service = TwoFactorAuthService()
         self.session_manager = SessionManager()
     
-    def test(self, description: str):
-        """Decorator for test functions."""
-        def decorator(func):
-            def wrapper(*args, **kwargs):
-                self.total_tests += 1
-                try:
-                    print(f"🧪 Testing: {description}")
-                    result = func(*args, **kwargs)
-                    if result is not False:
-                        print(f"   ✅ PASS")
-                        self.passed_tests += 1
-                    else:
-                        print(f"   ❌ FAIL")
-                        self.errors.append(f"Test failed: {description}")
-                except Exception as e:
-                    print(f"   ❌ ERROR: {e}")
-                    self.errors.append(f"Test error in '{description}': {e}")
-                print()
-            return wrapper
-        return decorator
+    @functools.cached_property
+    def rsa_keypair(self):
+        """RSA (private, public) keypair, generated once on first use."""
+        return self.encryption_service.generate_keypair()
+    
+    def run_test(self, description: str, func) -> Optional[str]:
+        """Run one registered validation test; returns its error message, or None if it passed."""
+        print(f"🧪 Testing: {description}")
+        # The test's own boundary, so one failure does not stop the rest
+        # (free on the success path since Python 3.11)
+        try:
+            result = func(self)
+        except Exception as e:
+            print(f"   ❌ ERROR: {e}\n")
+            return f"Test error in '{description}': {e}"
+        
+        if result is False:
+            print(f"   ❌ FAIL\n")
+            return f"Test failed: {description}"
+        
+        print(f"   ✅ PASS\n")
+        return None
     
     @test("Database initialization and table creation")
     def test_database_initialization(self):
         """Test database setup and table creation."""
-        # Check if all required tables exist
-        conn = sqlite3.connect(self.db.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
-        tables = [row[0] for row in cursor.fetchall()]
-        
-        required_tables = [
-            'security_logs', 'privacy_settings', 'compliance_reports',
+        # Check if all required tables exist, through the database's own
+        # connection (reopening ":memory:" would give a new, empty database).
+        # security_logs lives in monthly partition files registered in log_partitions.
+        with self.db._conn() as conn:
+            tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+        
+        required_tables = frozenset({
+            'log_partitions', 'privacy_settings', 'compliance_reports',
             'data_deletion_requests', 'user_sessions', 'encryption_keys',
             'two_factor_auth'
-        ]
+        })
         
-        for table in required_tables:
-            if table not in tables:
-                print(f"      Missing table: {table}")
-                return False
+        missing_tables = required_tables - tables
+        if missing_tables:
+            print(f"      Missing tables: {', '.join(sorted(missing_tables))}")
+            return False
         
-        conn.close()
         return True
     
     @test("Security event logging and retrieval")
@@ -92,22 +146,22 @@ class SecuritySystemValidator:
         """Test security event logging functionality."""
         user_id = "test_user_logging"
         
-        # Log multiple events
-        self.db.log_security_event(user_id, "login_attempt", "192.168.1.1", risk_score=2)
-        self.db.log_security_event(user_id, "password_change", "192.168.1.1", risk_score=5)
-        self.db.log_security_event(user_id, "2fa_enabled", "192.168.1.1", risk_score=0)
+        # Log multiple events in one transaction
+        self.db.log_security_events([
+            {"user_id": user_id, "action": "login_attempt", "ip_address": "192.168.1.1", "risk_score": 2},
+            {"user_id": user_id, "action": "password_change", "ip_address": "192.168.1.1", "risk_score": 5},
+            {"user_id": user_id, "action": "2fa_enabled", "ip_address": "192.168.1.1", "risk_score": 0}
+        ])
         
-        # Retrieve logs
-        logs = self.db.get_security_logs(user_id=user_id)
+        # Count the logs and check their risk scores in SQL
+        log_count, min_risk_score = self.db.security_log_stats(user_id)
         
-        if len(logs) != 3:
-            print(f"      Expected 3 logs, got {len(logs)}")
+        if log_count != 3:
+            print(f"      Expected 3 logs, got {log_count}")
             return False
         
-        # Check risk scores
-        risk_scores = [log['risk_score'] for log in logs]
-        if not all(score >= 0 for score in risk_scores):
-            print(f"      Invalid risk scores: {risk_scores}")
+        if min_risk_score is None or min_risk_score < 0:
+            print(f"      Invalid minimum risk score: {min_risk_score}")
             return False
         
         return True
@@ -118,27 +172,27 @@ class SecuritySystemValidator:
         # Create test video data
         test_data = b"This is test video data for encryption validation" * 100
         
-        # Create temporary files
-        with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-            temp_file.write(test_data)
-            temp_file_path = temp_file.name
+        import tempfile
         
-        try:
+        # Encrypt straight from memory; only the encrypted and decrypted files
+        # touch the filesystem (tmpfs when available)
+        scratch_dir = "/dev/shm" if os.access("/dev/shm", os.W_OK) else None
+        with tempfile.TemporaryDirectory(dir=scratch_dir) as temp_dir:
             # Encrypt file
-            encrypted_path = temp_file_path + ".encrypted"
-            result = self.encryption_service.encrypt_file(temp_file_path, encrypted_path)
+            encrypted_path = os.path.join(temp_dir, "video.encrypted")
+            result = self.encryption_service.encrypt_stream(io.BytesIO(test_data), encrypted_path)
             
             if not os.path.exists(encrypted_path):
                 print("      Encrypted file not created")
                 return False
             
             # Verify encryption result
-            if not all(key in result for key in ['key', 'file_hash', 'encrypted_file']):
+            if not FILE_ENCRYPTION_RESULT_KEYS.issubset(result):
                 print(f"      Missing keys in result: {result.keys()}")
                 return False
             
             # Decrypt file
-            decrypted_path = temp_file_path + ".decrypted"
+            decrypted_path = os.path.join(temp_dir, "video.decrypted")
             success = self.encryption_service.decrypt_file(
                 encrypted_path, decrypted_path, result['key'], result['file_hash']
             )
@@ -148,20 +202,11 @@ class SecuritySystemValidator:
                 return False
             
             # Verify content
-            with open(decrypted_path, 'rb') as f:
-                decrypted_data = f.read()
-            
-            if decrypted_data != test_data:
+            if not file_matches(decrypted_path, test_data):
                 print("      Decrypted data doesn't match original")
                 return False
             
             return True
-            
-        finally:
-            # Cleanup
-            for path in [temp_file_path, encrypted_path, decrypted_path]:
-                if os.path.exists(path):
-                    os.unlink(path)
     
     @test("Data encryption and decryption")
     def test_data_encryption(self):
@@ -171,7 +216,7 @@ class SecuritySystemValidator:
         # Encrypt data
         result = self.encryption_service.encrypt_data(test_data)
         
-        if not all(key in result for key in ['encrypted_data', 'key']):
+        if not DATA_ENCRYPTION_RESULT_KEYS.issubset(result):
             print(f"      Missing keys in result: {result.keys()}")
             return False
         
@@ -180,7 +225,7 @@ class SecuritySystemValidator:
             result['encrypted_data'], result['key']
         )
         
-        if decrypted_data != test_data:
+        if decrypted_data is None or not hmac.compare_digest(decrypted_data, test_data):
             print("      Decrypted data doesn't match original")
             return False
         
@@ -191,8 +236,8 @@ class SecuritySystemValidator:
         """Test RSA public/private key encryption."""
         test_data = b"Secret message for asymmetric encryption"
         
-        # Generate keypair
-        private_key, public_key = self.encryption_service.generate_keypair()
+        # Reuse the validator's keypair
+        private_key, public_key = self.rsa_keypair
         
         # Encrypt with public key
         encrypted_data = self.encryption_service.encrypt_with_public_key(test_data, public_key)
@@ -200,7 +245,7 @@ class SecuritySystemValidator:
         # Decrypt with private key
         decrypted_data = self.encryption_service.decrypt_with_private_key(encrypted_data, private_key)
         
-        if decrypted_data != test_data:
+        if not hmac.compare_digest(decrypted_data, test_data):
             print("      Asymmetric decryption failed")
             return False
         
@@ -209,23 +254,27 @@ class SecuritySystemValidator:
     @test("Data anonymization features")
     def test_data_anonymization(self):
         """Test data anonymization functionality."""
-        # Test IP anonymization
         ip = "192.168.1.100"
-        anon_ip = DataAnonymizer.anonymize_ip_address(ip)
+        email = "john.doe@example.com"
+        text = "SSN: 123-45-6789 and credit card: 1234-5678-9012-3456"
+        
+        # Anonymize all three fields in one call
+        anonymized = DataAnonymizer.anonymize_batch({"ip": ip, "email": email, "text": text})
+        
+        # Test IP anonymization
+        anon_ip = anonymized["ip"]
         if anon_ip != "192.168.1.0":
             print(f"      IP anonymization failed: {ip} -> {anon_ip}")
             return False
         
         # Test email anonymization
-        email = "john.doe@example.com"
-        anon_email = DataAnonymizer.anonymize_email(email)
+        anon_email = anonymized["email"]
         if not anon_email.endswith("@example.com") or "john.doe" in anon_email:
             print(f"      Email anonymization failed: {email} -> {anon_email}")
             return False
         
         # Test text anonymization
-        text = "SSN: 123-45-6789 and credit card: 1234-5678-9012-3456"
-        anon_text = DataAnonymizer.anonymize_text_data(text)
+        anon_text = anonymized["text"]
         if "123-45-6789" in anon_text or "1234-5678-9012-3456" in anon_text:
             print(f"      Text anonymization failed")
             return False
@@ -322,7 +371,7 @@ class SecuritySystemValidator:
         # Generate QR code
         qr_code = self.totp_service.generate_qr_code("test@example.com", secret)
         
-        if not qr_code.startswith("data:image/png;base64,"):
+        if not qr_code.startswith(("data:image/svg+xml;base64,", "data:image/png;base64,")):
             print(f"      Invalid QR code format")
             return False
         
@@ -344,22 +393,25 @@ class SecuritySystemValidator:
     @test("Session management and risk scoring")
     def test_session_management(self):
         """Test session creation and risk scoring."""
-        user_id = "test_user_session"
-        ip_address = "192.168.1.1"
-        
-        # Create session
-        session_token = self.db.create_user_session(user_id, ip_address)
+        user_ids = [f"test_user_session_{i}" for i in range(3)]
+        ip_addresses = [f"192.168.1.{i + 1}" for i in range(3)]
         
-        if not session_token or len(session_token) < 32:
-            print(f"      Invalid session token: {session_token}")
-            return False
+        # Create sessions (one transaction for all users)
+        session_tokens = self.db.create_user_sessions(user_ids, ip_addresses)
         
-        # Validate session
-        validated_user = self.db.validate_session(session_token)
+        for user_id, session_token in zip(user_ids, session_tokens):
+            if not session_token or len(session_token) < 32:
+                print(f"      Invalid session token: {session_token}")
+                return False
+            
+            # Validate session
+            validated_user = self.db.validate_session(session_token)
+            
+            if validated_user != user_id:
+                print(f"      Session validation failed: {validated_user}")
+                return False
         
-        if validated_user != user_id:
-            print(f"      Session validation failed: {validated_user}")
-            return False
+        user_id, ip_address = user_ids[0], ip_addresses[0]
         
         # Test risk scoring
         risk_score = self.session_manager.calculate_risk_score(
@@ -420,7 +472,9 @@ class SecuritySystemValidator:
         
         # Set up test data
         self.db.set_privacy_setting(user_id, "data_sharing_opt_out", "true")
-        self.db.log_security_event(user_id, "data_access", "192.168.1.1")
+        self.db.log_security_events([
+            {"user_id": user_id, "action": "data_access", "ip_address": "192.168.1.1"}
+        ])
         
         # Generate GDPR report
         gdpr_report_id = self.db.generate_compliance_report("gdpr_data_export", user_id)
@@ -512,11 +566,25 @@ class SecuritySystemValidator:
             "docker-compose.yml"
         ]
         
+        # List each directory once instead of stat-ing every file
+        names_by_dir = defaultdict(set)
         for file_path in required_files:
-            full_path = base_path / file_path
-            if not full_path.exists():
+            directory, name = os.path.split(file_path)
+            names_by_dir[directory].add(name)
+        
+        missing_files = []
+        for directory, names in names_by_dir.items():
+            try:
+                with os.scandir(base_path / directory) as entries:
+                    present = {entry.name for entry in entries}
+            except FileNotFoundError:
+                present = set()
+            missing_files.extend(os.path.join(directory, name) for name in names - present)
+        
+        if missing_files:
+            for file_path in sorted(missing_files):
                 print(f"      Missing file: {file_path}")
-                return False
+            return False
         
         # Check if setup script is executable
         setup_script = base_path / "setup_security.sh"
@@ -528,26 +596,67 @@ class SecuritySystemValidator:
     
     def test_api_endpoints(self):
         """Test API endpoints (requires running server)."""
-        base_url = "http://localhost:8008"
+        # A single GET does not need requests and its import cost
+        connection = http.client.HTTPConnection("localhost", 8008, timeout=5)
         
         try:
             # Test health endpoint
-            response = requests.get(f"{base_url}/security/health", timeout=5)
-            if response.status_code == 200:
+            connection.request("GET", "/security/health")
+            status = connection.getresponse().status
+            if status == 200:
                 print("✅ API health check successful")
                 return True
             else:
-                print(f"❌ API health check failed: {response.status_code}")
+                print(f"❌ API health check failed: {status}")
                 return False
-        except requests.exceptions.RequestException as e:
+        except (OSError, http.client.HTTPException) as e:
             print(f"⚠️  API not running (this is expected): {e}")
             return None  # Not a failure, just not running
+        finally:
+            connection.close()
     
     def run_external_tests(self):
         """Run external security tests."""
         backend_path = Path(__file__).parent / "backend"
         
         print("🧪 Running pytest security tests...")
+        # Imported here: pytest is heavy and only this step needs it
+        try:
+            import pytest
+        except ImportError:
+            self.run_external_tests_subprocess(backend_path)
+            return
+        
+        # Run in this interpreter: no second start-up and re-import of the
+        # crypto and database modules. Like the subprocess it runs from the
+        # backend directory (where the API creates its database); pytest's
+        # report is kept quiet.
+        report = io.StringIO()
+        try:
+            with contextlib.chdir(backend_path), contextlib.redirect_stdout(report):
+                exit_code = pytest.main(["security_tests.py", "-q", "--tb=short", "-p", "no:cacheprovider"])
+        except Exception as e:
+            print(f"   ❌ Error running pytest: {e}")
+            self.errors.append(f"Pytest error: {e}")
+            self.total_tests += 1
+            return
+        
+        if exit_code == 0:
+            print("   ✅ All pytest tests passed")
+            self.passed_tests += 1
+        else:
+            print("   ❌ Some pytest tests failed")
+            for line in report.getvalue().splitlines():
+                if line.startswith(("FAILED", "ERROR")):
+                    print(f"   {line}")
+            self.errors.append("Pytest tests failed")
+        
+        self.total_tests += 1
+    
+    def run_external_tests_subprocess(self, backend_path: Path):
+        """Run the pytest security tests in a child interpreter (when pytest is not importable here)."""
+        import subprocess
+        
         try:
             result = subprocess.run(
                 ["python", "-m", "pytest", "security_tests.py", "-v", "--tb=short"],
@@ -586,29 +695,28 @@ class SecuritySystemValidator:
         
         start_time = time.time()
         
-        # Run all test methods
-        test_methods = [
-            self.test_database_initialization,
-            self.test_security_logging,
-            self.test_video_encryption,
-            self.test_data_encryption,
-            self.test_asymmetric_encryption,
-            self.test_data_anonymization,
-            self.test_password_security,
-            self.test_jwt_tokens,
-            self.test_rbac,
-            self.test_2fa_setup,
-            self.test_session_management,
-            self.test_privacy_settings,
-            self.test_data_deletion,
-            self.test_compliance_reports,
-            self.test_api_keys,
-            self.test_encryption_key_storage,
-            self.test_file_structure
-        ]
-        
-        for test_method in test_methods:
-            test_method()
+        # The registered tests are independent (distinct user_ids, no shared
+        # state besides the pooled database) and spend most of their time in C
+        # code that releases the GIL, so they run on a thread pool. Each
+        # thread's output is kept apart and written out in registration order,
+        # in a single write. Unless verbose, passing tests' output is dropped
+        # without ever being encoded for the terminal.
+        output = ThreadOutput()
+        
+        def run_captured(entry):
+            error = self.run_test(*entry)
+            test_output = output.take()
+            return error, test_output if self.verbose or error else ""
+        
+        with contextlib.redirect_stdout(output), ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            results = list(executor.map(run_captured, VALIDATION_TESTS))
+        sys.stdout.write("".join(test_output for _, test_output in results))
+        
+        # Tally once, in this thread, rather than under a lock per test
+        test_errors = [error for error, _ in results if error is not None]
+        self.total_tests += len(results)
+        self.passed_tests += len(results) - len(test_errors)
+        self.errors.extend(test_errors)
         
         # Run external tests
         self.run_external_tests()
@@ -673,7 +781,12 @@ class SecuritySystemValidator:
 
 def main():
     """Main validation function."""
-    validator = SecuritySystemValidator()
+    parser = argparse.ArgumentParser(description="Validate the SkillMirror security system.")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="show every test's output, not only failures")
+    args = parser.parse_args()
+    
+    validator = SecuritySystemValidator(verbose=args.verbose)
     success = validator.run_all_tests()
     
     if success: